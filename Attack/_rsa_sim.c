@@ -0,0 +1,129 @@
+//  GMP implementation of the do_sim_chunk loop in RSAAttack.py.
+//  Build with: python setup.py build_ext --inplace
+//
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <gmp.h>
+#include <string.h>
+
+typedef struct {
+    mpz_t n, nprime, t, m;
+    mp_bitcnt_t k;
+} mont_ctx;
+
+/*
+ * Montgomery product of a and b, stored in res. r = 2^k, so reduction
+ * mod r is a mask and division by r is a shift.
+ *
+ * Returns 1 if the final subtraction (step 4) was made, 0 otherwise.
+ */
+static int MontgomeryProduct(mpz_t res, const mpz_t a, const mpz_t b, mont_ctx *ctx){
+    mpz_mul(ctx->t, a, b);
+    mpz_mul(ctx->m, ctx->t, ctx->nprime);
+    mpz_fdiv_r_2exp(ctx->m, ctx->m, ctx->k);
+    mpz_addmul(ctx->t, ctx->m, ctx->n);
+    mpz_tdiv_q_2exp(res, ctx->t, ctx->k);
+    if (mpz_cmp(res, ctx->n) >= 0) {
+        mpz_sub(res, res, ctx->n);
+        return 1;
+    }
+    return 0;
+}
+
+/*
+ * Residues are passed in and out as fixed-width rows of little-endian
+ * 64-bit words, so they are copied with mpz_import/mpz_export instead of
+ * going through Python integers.
+ */
+static size_t row_words(mp_bitcnt_t k){
+    return (k + 63) / 64;
+}
+
+PyDoc_STRVAR(do_sim_step_doc,
+"do_sim_step(mms, x_bars, n_hex, nprime_hex, k) -> (subs, x_sq, x_mul)\n\n"
+"Advances the simulated signing of each message by one bit of the key,\n"
+"guessing that the bit is 1. mms are the messages in Montgomery form and\n"
+"x_bars the ladder states after the bits derived so far, both as buffers of\n"
+"rows of (k + 63) // 64 little-endian 64-bit words. Returns whether a\n"
+"subtraction was made during step4 in the multiplication (one byte per\n"
+"message), and the states after the squaring and after the multiplication\n"
+"in the same row layout.");
+
+static PyObject *do_sim_step(PyObject *self, PyObject *args){
+    Py_buffer mms, x_bars;
+    PyObject *subs = NULL, *x_sq = NULL, *x_mul = NULL;
+    const char *n_hex, *nprime_hex;
+    unsigned long k;
+    if (!PyArg_ParseTuple(args, "y*y*ssk", &mms, &x_bars, &n_hex, &nprime_hex, &k)) {
+        return NULL;
+    }
+    size_t words = row_words(k), width = words * 8;
+    Py_ssize_t count = 0;
+
+    mont_ctx ctx;
+    mpz_t mm, x_bar;
+    mpz_inits(ctx.n, ctx.nprime, ctx.t, ctx.m, mm, x_bar, NULL);
+    ctx.k = k;
+    if (k == 0 || mms.len != x_bars.len || mms.len % width != 0) {
+        PyErr_SetString(PyExc_ValueError, "mms and x_bars must hold the same number of rows of (k + 63) // 64 words");
+        goto done;
+    }
+    count = mms.len / width;
+    if (mpz_set_str(ctx.n, n_hex, 16) != 0 || mpz_set_str(ctx.nprime, nprime_hex, 16) != 0) {
+        PyErr_SetString(PyExc_ValueError, "n and nprime must be hex strings");
+        goto done;
+    }
+    if (mpz_sizeinbase(ctx.n, 2) > k) {
+        PyErr_SetString(PyExc_ValueError, "n must be below 2^k");
+        goto done;
+    }
+    subs = PyBytes_FromStringAndSize(NULL, count);
+    x_sq = PyBytes_FromStringAndSize(NULL, mms.len);
+    x_mul = PyBytes_FromStringAndSize(NULL, mms.len);
+    if (subs == NULL || x_sq == NULL || x_mul == NULL) {
+        goto done;
+    }
+    char *sub_out = PyBytes_AS_STRING(subs);
+    char *sq_out = PyBytes_AS_STRING(x_sq);
+    char *mul_out = PyBytes_AS_STRING(x_mul);
+    const char *mm_in = mms.buf, *x_in = x_bars.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+    memset(sq_out, 0, mms.len);
+    memset(mul_out, 0, mms.len);
+    for (Py_ssize_t i = 0; i < count; i++) {
+        size_t off = i * width;
+        mpz_import(mm, words, -1, 8, -1, 0, mm_in + off);
+        mpz_import(x_bar, words, -1, 8, -1, 0, x_in + off);
+        MontgomeryProduct(x_bar, x_bar, x_bar, &ctx);
+        mpz_export(sq_out + off, NULL, -1, 8, -1, 0, x_bar);
+        sub_out[i] = (char)MontgomeryProduct(x_bar, mm, x_bar, &ctx);
+        mpz_export(mul_out + off, NULL, -1, 8, -1, 0, x_bar);
+    }
+    Py_END_ALLOW_THREADS
+
+done:
+    mpz_clears(ctx.n, ctx.nprime, ctx.t, ctx.m, mm, x_bar, NULL);
+    PyBuffer_Release(&mms);
+    PyBuffer_Release(&x_bars);
+    if (PyErr_Occurred()) {
+        Py_XDECREF(subs);
+        Py_XDECREF(x_sq);
+        Py_XDECREF(x_mul);
+        return NULL;
+    }
+    return Py_BuildValue("(NNN)", subs, x_sq, x_mul);
+}
+
+static PyMethodDef rsa_sim_methods[] = {
+    {"do_sim_step", do_sim_step, METH_VARARGS, do_sim_step_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef rsa_sim_module = {
+    PyModuleDef_HEAD_INIT, "_rsa_sim", NULL, -1, rsa_sim_methods
+};
+
+PyMODINIT_FUNC PyInit__rsa_sim(void){
+    return PyModule_Create(&rsa_sim_module);
+}
@@ -5,7 +5,8 @@ setwd(wd)
 print(wd)
 file.names <- dir(wd, pattern=".dat")
 for(i in 1:length(file.names)){
-    w1 <- read.csv(paste(file.names[i], sep=""))
+    w1 <- read.csv(paste(file.names[i], sep=""), colClasses=c(message_hex="character", signature_hex="character"))
+    w1$message <- as.numeric(paste0("0x", w1$message_hex))
     rev(w1)
     true <- subset(w1, w1$step4 == 1)
     false <- subset(w1, w1$step4 == 2)
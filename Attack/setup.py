@@ -0,0 +1,7 @@
+""" Builds the optional GMP extension used by RSAAttack.py.
+	python setup.py build_ext --inplace
+"""
+from setuptools import setup, Extension
+
+setup(name='_rsa_sim',
+	  ext_modules=[Extension('_rsa_sim', ['_rsa_sim.c'], libraries=['gmp'])])
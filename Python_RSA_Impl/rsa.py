@@ -1,7 +1,14 @@
-import math, copy, random
+import copy, random, functools
+from concurrent.futures import ProcessPoolExecutor
+try:
+	from gmpy2 import mpz
+except ImportError:
+	mpz = int
 
 keys = {}
 config = {}
+# Below this many blocks, decrypting serially is faster than starting worker processes.
+PARALLEL_MIN_BLOCKS = 64
 
 def init():
 	""" NB! Keys are hardcoded for repeatability
@@ -20,6 +27,9 @@ def init():
 	config = {'p': p,
 			 'q': q,
 			 'tot_n': tot_n,
+			 'dP': d % (p-1),			# private, CRT exponents
+			 'dQ': d % (q-1),
+			 'qInv': ModInverse(q, p),
 			 'block_size': 83 }
 	keys = {'n': n,
 			'e': e,
@@ -29,70 +39,103 @@ def init():
 
 def ModInverse(a, n):
 	""" Calculates the modular inverse of a mod n.
-		http://www.wikiwand.com/en/Extended_Euclidean_algorithm#/Modular_integers
+		Uses the extended Euclidean algorithm built into pow() (Python >= 3.8).
 	"""
-	(t, new_t, r, new_r) = 0, 1, int(n), int(a)
-	while new_r != 0:
-		quotient = r//new_r
-		(t, new_t) = (new_t, t - quotient * new_t)
-		(r, new_r) = (new_r, r - quotient * new_r)
-	if r > 1:
-		raise ArithmeticError("ERROR: %d is not invertible modulo %d. \n r was: %d, new_r was %d " % (a, n, r, new_r))
-	if t < 0:
-		t = t + n
-	return t
-
-def MongomeryProduct(a, b, nprime, r, n):
-	""" Montgomery product."""
+	try:
+		return pow(int(a) % int(n), -1, int(n))
+	except ValueError:
+		raise ArithmeticError("ERROR: %d is not invertible modulo %d." % (a, n))
+
+def MongomeryProduct(a, b, nprime, r_mask, k, n):
+	""" Montgomery product. r = 2^k, so mod r is a mask and //r is a shift."""
 	t = a * b
-	m = t * nprime % r
-	u = (t + m*n)//r
+	m = (t * nprime) & r_mask
+	u = (t + m*n) >> k
 	return u-n if (u >= n) else u
 
+@functools.lru_cache(maxsize=4)
 def nPrime(n):
 	""" Calculates r^{-1} and n' as used in Montgomery exponentiation"""
 	# n is a k-bit number.
 	# r should be 2^k
-	k = math.floor(math.log2(int(n))) + 1
-	r = int(math.pow(2, k))
+	k = int(n).bit_length()
+	r = 1 << k
 	rInverse = ModInverse(r, n)
 	nPrime = (r * rInverse -1) // n
-	return (r, nPrime)
-
-def num2bits(num):
-	bits = []
-	k = math.floor(math.log2(num)) + 1
-	for i in list(reversed(list(range(0,k)))):
-		bits.append(num >> i & 1)
-	return bits
+	return (mpz(r), mpz(nPrime), k)
 
-
-def ModExp(M, d, n):
-	""" Montgomery binary exponentiation"""
+def ModExp(M, d, n, w=4):
+	""" Montgomery fixed-window exponentiation, processing w bits of d at a time"""
 	if n%2 != 1:
 		raise ValueError("N must be odd!")
-	(r, nprime) = nPrime(n)
+	(r, nprime, k) = nPrime(n)
+	n = mpz(n)
+	r_mask = r - 1
 	M_bar = (M * r) % n
 	x_bar = 1 * r % n
-	bit_list = num2bits(d)
-	for e_i in bit_list:
-		x_bar = MongomeryProduct(x_bar, x_bar, nprime, r, n)
-		if e_i == 1:
-			x_bar = MongomeryProduct(M_bar, x_bar, nprime, r, n)
-	x = MongomeryProduct(x_bar, 1, nprime, r, n)
-	return x
+	# T[i] is M^i in Montgomery form
+	T = [x_bar, M_bar]
+	for i in range(2, 1 << w):
+		T.append(MongomeryProduct(T[i-1], M_bar, nprime, r_mask, k, n))
+	w_mask = (1 << w) - 1
+	# Walk the windows of d from the most significant end, padding it to a whole number of windows
+	# MongomeryProduct is inlined below to avoid the call overhead in the main loop.
+	for i in range((d.bit_length() - 1) // w * w, -1, -w):
+		for _ in range(w):
+			_t = x_bar * x_bar
+			_m = (_t * nprime) & r_mask
+			_u = (_t + _m*n) >> k
+			x_bar = _u-n if (_u >= n) else _u
+		_t = T[(d >> i) & w_mask] * x_bar
+		_m = (_t * nprime) & r_mask
+		_u = (_t + _m*n) >> k
+		x_bar = _u-n if (_u >= n) else _u
+	x = MongomeryProduct(x_bar, 1, nprime, r_mask, k, n)
+	return int(x)
+
+def _pow_65537(M, n):
+	""" M^65537 mod n, i.e. 16 Montgomery squarings and one multiply"""
+	if n%2 != 1:
+		raise ValueError("N must be odd!")
+	(r, nprime, k) = nPrime(n)
+	n = mpz(n)
+	r_mask = r - 1
+	M_bar = (M << k) % n
+	x_bar = M_bar
+	for _ in range(16):
+		x_bar = MongomeryProduct(x_bar, x_bar, nprime, r_mask, k, n)
+	x_bar = MongomeryProduct(M_bar, x_bar, nprime, r_mask, k, n)
+	x = MongomeryProduct(x_bar, 1, nprime, r_mask, k, n)
+	return int(x)
 
 def encrypt(message):
 	""" Encrypt a message using the public key in getKeys()""" 
 	e, n = keys['e'], keys['n']
 	number_list = string2num(message)
 	blocks = num2blocks(number_list, config['block_size'])
+	if e == 65537:
+		return [_pow_65537(block, n) for block in blocks]
 	return [ModExp(block, e, n) for block in blocks]
 
+def _modexp_crt(c, dP, dQ, p, q, qInv):
+	""" c^d mod pq from the CRT exponents dP, dQ and qInv = q^{-1} mod p"""
+	m_p = ModExp(c % p, dP, p)
+	m_q = ModExp(c % q, dQ, q)
+	h = (qInv * (m_p - m_q)) % p
+	return m_q + h*q
+
 def decrypt(ciphertext):
-	""" Decrypt a ciphertext using the private key in getKeys()"""
-	d, n = keys['d'], keys['n']
-	blocks = [ModExp(block, d, n) for block in ciphertext]
+	""" Decrypt a ciphertext using the private key in getKeys().
+		Uses the CRT decomposition of d, i.e. two half-size exponentiations mod p and q.
+		Long ciphertexts are decrypted in parallel.
+	"""
+	crt = functools.partial(_modexp_crt, dP=config['dP'], dQ=config['dQ'],
+							p=config['p'], q=config['q'], qInv=config['qInv'])
+	if len(ciphertext) < PARALLEL_MIN_BLOCKS:
+		blocks = [crt(c) for c in ciphertext]
+	else:
+		with ProcessPoolExecutor() as ex:
+			blocks = list(ex.map(crt, ciphertext))
 	number_list = blocks2num(blocks, config['block_size'])
 	return num2string(number_list)
 	# return ModExp(int(ciphertext), int(d), int(n))